@@ -1,5 +1,5 @@
 import asyncio
-from datetime import datetime, timedelta
+from time import monotonic
 
 
 DEFAULT_ACTIVE_TIMEOUT_M = 30
@@ -9,7 +9,8 @@ class GuildRecord:
     """Represents additional per-guild information like settings & VCs.
 
     Specifically:
-        1. The last channel a voice-related command was executed & when
+        1. The last channel a voice-related command was executed & when it
+            should time out
         2. The Lock used by that guild to prevent spam-based issues
     """
 
@@ -19,34 +20,40 @@ class GuildRecord:
     def __init__(self, orig_guild):
         self.guild = orig_guild
         self.last_channel = None
-        self.last_dt = None
-        self.lock = asyncio.Lock()
+        # Monotonic time at which this record times out; None once inactive
+        self.deadline = None
+        self._lock = None
         self.searching_ytdl = False
         self.sb_task = None
 
+    @property
+    def lock(self):
+        """The Lock for this guild, created the first time it's needed."""
+        # Most guilds never use voice, so don't allocate one for all of them
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        return self._lock
+
     @property
     def is_active(self):
         """Return if the guild is active."""
-        # If we still have a last_dt set, we haven't timed out this record
-        return self.last_dt is not None
+        # If we still have a deadline set, we haven't timed out this record
+        return self.deadline is not None
 
     @property
     def should_timeout(self):
         """Return if the guild should be timed out."""
-        return (
-            self.last_dt + timedelta(minutes=self.active_timeout_m)
-                < datetime.now()
-            if self.last_dt else False
-        )
+        # Same clock as the event loop's, so wall-clock jumps don't matter
+        return self.deadline is not None and monotonic() >= self.deadline
 
     def mark_inactive(self):
         """Officially mark the guild as inactive."""
-        self.last_dt = None
+        self.deadline = None
 
     def update(self, last_channel=None):
         """Update the object by recording the new most recent command."""
         self.last_channel = last_channel or self.last_channel
-        self.last_dt = datetime.now()
+        self.deadline = monotonic() + self.active_timeout_m * 60
 
     async def send(self, msg):
         """Send a message to my last channel if I have one, else do nothing."""
@@ -87,8 +94,19 @@ class GuildDB:
     def add_guild(self, guild):
         self.records[guild.id] = GuildRecord(guild)
 
+    def get_record(self, guild):
+        """Return the record for a guild, creating it if it doesn't exist yet.
+
+        Commands can arrive before every guild has been added, so anything
+        handling a command should go through this.
+        """
+        record = self.records.get(guild.id)
+        if record is None:
+            record = self.records[guild.id] = GuildRecord(guild)
+        return record
+
     def update_record(self, ctx):
-        self.records[ctx.guild.id].update(ctx.channel)
+        self.get_record(ctx.guild).update(ctx.channel)
 
     @property
     def guilds_records_to_timeout(self):
@@ -20,4 +20,8 @@ async def main():
 
 
 if __name__ == '__main__':
-    asyncio.run(main())
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        # The bot only installs its own SIGINT handler once it starts running
+        pass
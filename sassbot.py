@@ -1,10 +1,12 @@
 import asyncio
+from collections import defaultdict
 from discord import Game, Intents
 from discord.ext import commands
 from discord.errors import HTTPException
-from random import choice
+from random import choice, random
 import signal
 import logging
+from logging.handlers import MemoryHandler
 from websockets.exceptions import ConnectionClosedOK
 
 from exceptions import BananaCrime
@@ -15,6 +17,7 @@ from guilddb import GuildDB
 # Defaults
 DEFAULT_ACTIVE_TIMEOUT_CHECK_INTERVAL_S = 60
 DEFAULT_ACTIVE_TIMEOUT_M = 30
+DEFAULT_LOG_FLUSH_INTERVAL_S = 30
 
 LOGGER = logging.getLogger(__name__)
 
@@ -32,11 +35,13 @@ class SassBot(commands.Bot):
         active_timeout_m (int, Optional): The number of minutes of inactivity
             before the bot's session becomes inactive and will therefore not
             send shutdown messages and will disconnect from any voice channels.
+        log_flush_interval_s (int, Optional): The number of seconds between
+            each time the bot flushes buffered log messages.
         voice_settings (dict, Optional): Settings to initialize VoiceController
     """
 
     # Used to give error messages more personality
-    BANANA_NAMES = [
+    BANANA_NAMES = (
         'banana',
         'bafoon',
         'dingus',
@@ -46,11 +51,43 @@ class SassBot(commands.Bot):
         'fiend',
         'doofus',
         'goose',
-        'oaf',
+        'oaf'
+    )
+    # Longer names that are only used every once in a while
+    RARE_BANANA_NAMES = (
         "big stinky banana that evidently is the big banana and cannot type "
             "beep boop bop on his/her keyboard like omg what's up with this "
-            "guy lol xD"
-    ]
+            "guy lol xD",
+    )
+    # Chance of using a rare name; keeps each name equally likely overall
+    RARE_BANANA_NAME_CHANCE = len(RARE_BANANA_NAMES) \
+        / (len(BANANA_NAMES) + len(RARE_BANANA_NAMES))
+    # Replies to command errors that need no special handling, keyed by the
+    #   exact exception type; formatted with the exception (ex), the command
+    #   prefix (prefix), the failed command (command), and a name (banana)
+    ERROR_RESPONSES = {
+        commands.errors.CommandNotFound: 'Invalid command.',
+        commands.errors.MissingRequiredArgument:
+            'You did not specify the correct number of arguments. '
+            'Try running `{prefix}help {command.name}`, you {banana}.',
+        commands.errors.NotOwner: "You aren't my owner, you banana.",
+        commands.errors.BadArgument:
+            '{ex.args[0]} '
+            'Try running `{prefix}help {command.name}`, you {banana}.',
+        commands.errors.UnexpectedQuoteError:
+            "If you include a quote in an argument, you'll either need to "
+            "fully encase what you're trying to send me in quotes, or you "
+            "need to escape it, you {banana}.",
+        commands.errors.InvalidEndOfQuotedStringError:
+            "You cannot place a character directly after the end of a "
+            "quoted string, you {banana}.",
+        commands.errors.ExpectedClosingQuoteError:
+            "You did not complete your quoted string, you {banana}.",
+        commands.errors.ChannelNotFound:
+            "That channel doesn't exist; make sure to match casing "
+            "and encase the channel name in quotes if it has spaces in it, "
+            "you {banana}."
+    }
     # Message sent to all guilds with an active voice connection upon shutdown
     SHUTDOWN_MESSAGE = "Greetings, gamers. The higher powers have issued a " \
         "shutdown, therefore I shall now disappear. Fret not, my friends, " \
@@ -62,10 +99,23 @@ class SassBot(commands.Bot):
         kwargs['intents'] = Intents.default()
         kwargs['intents'].message_content = True
 
-        # Used for error customization
-        self.err_count = {}
+        # Used for error customization; maps user IDs to error streaks
+        self.err_count = defaultdict(int)
         # Manages additional per-guild info
         self.guild_db = GuildDB()
+        # Background tasks started once we've logged in
+        self.inactivity_task = None
+        self.log_flush_task = None
+        # Buffered log handlers to flush periodically; the loggers configured
+        #   in settings.json all share the ones attached to this module's
+        self.log_buffers = [
+            handler for handler in LOGGER.handlers
+            if isinstance(handler, MemoryHandler)
+        ]
+        # Set by SIGINT to make run() return
+        self._stop_requested = asyncio.Event()
+        # The task running run(), which close() must never cancel
+        self._main_task = None
 
         super().__init__(**kwargs)
 
@@ -83,23 +133,30 @@ class SassBot(commands.Bot):
         self.active_timeout_m = kwargs.pop(
             'active_timeout_m', DEFAULT_ACTIVE_TIMEOUT_M
         )
+        self.log_flush_interval_s = kwargs.pop(
+            'log_flush_interval_s', DEFAULT_LOG_FLUSH_INTERVAL_S
+        )
         self._token = kwargs.pop('token')
         self.voice_settings = kwargs.pop('voice_settings', dict())
 
     # Running/Stopping #
     def _sigint_handler(self):
-        """SIGINT handler that, when triggered, stops the bot.
+        """SIGINT handler that, when triggered, makes run() return.
 
-        This is simply close() but with an additional log message.
+        The bot itself is then stopped by leaving `async with`, which keeps
+        close() in the main task instead of racing it from a separate one.
         """
         LOGGER.info('Caught SIGINT')
-        self.loop.create_task(self.close())
+        self._stop_requested.set()
 
     async def run(self):
         """Start bot, keeping control within this object.
 
         Control will cease on SIGINT or an unrecoverable exception.
+        NOTE: Must be run within `async with`, which stops the bot once this
+            returns.
         """
+        self._main_task = asyncio.current_task()
         self.loop.add_signal_handler(
             signal.SIGINT, lambda: self._sigint_handler()
         )
@@ -109,36 +166,54 @@ class SassBot(commands.Bot):
             await self.add_cog(self.voice_controller)
             await self._prepare_to_serve()
 
-            await self.connect()
+            connect_task = self.loop.create_task(self.connect())
+            stop_task = self.loop.create_task(self._stop_requested.wait())
+            await asyncio.wait(
+                (connect_task, stop_task),
+                return_when=asyncio.FIRST_COMPLETED
+            )
+            # Surface any exception that stopped the connection
+            if connect_task.done():
+                connect_task.result()
+            # Whichever task is left gets cancelled by close()
         except Exception:
             # NOTE: This exception isn't re-raised since it's logged
-            #   and will trigger the bot's shutdown procedure
+            #   and leaving `async with` will trigger the shutdown procedure
             LOGGER.critical(
                 'Encountered the following unrecoverable top-level exception; '
                 'stopping bot...',
                 exc_info=True
             )
-            await self.close()
-        finally:
-            LOGGER.info('Bot stopped')
 
     async def _prepare_to_serve(self):
-        """Connect to Discord and initialize objects that need the data.
+        """Log in to Discord and start background tasks.
 
-        NOTE: By default, database will be populated with at most 100 guilds.
+        NOTE: Guild records are populated in on_ready from the gateway's guild
+            cache, which holds every guild I'm in; commands arriving before
+            then create their guild's record on demand.
         """
         await self.login(self._token)
-        async for guild in self.fetch_guilds():
-            self.guild_db.add_guild(guild)
 
         # Start checking for inactive voice clients
         self.inactivity_task = self.loop.create_task(self.inactivity_checker())
+        # Periodically write out buffered logs
+        self.log_flush_task = self.loop.create_task(self.log_flusher())
 
     async def close(self):
-        """Stop the bot."""
+        """Stop the bot.
+
+        NOTE: Cancels every other task except the one running run(), since
+            discord.py may call this from within connect() on fatal errors.
+        """
+        # discord.py clears self.loop during super().close(), so hold onto it
+        loop = asyncio.get_running_loop()
         LOGGER.info('Stopping bot...')
         await self.tell_active_guilds(self.SHUTDOWN_MESSAGE)
-        self.inactivity_task.cancel()
+        # These won't exist if we failed before finishing logging in
+        if self.inactivity_task:
+            self.inactivity_task.cancel()
+        if self.log_flush_task:
+            self.log_flush_task.cancel()
         await self.voice_controller.close()
 
         await super().close()
@@ -146,31 +221,32 @@ class SassBot(commands.Bot):
         tasks = [
             task for task in asyncio.all_tasks()
             if task is not asyncio.current_task()
+                and task is not self._main_task
         ]
         LOGGER.debug('Cancelling all tasks...')
         for task in tasks:
             LOGGER.debug(f'Cancelling {task}')
             task.cancel()
-        await asyncio.gather(*tasks, return_exceptions=True)
+        results = await asyncio.gather(*tasks, return_exceptions=True)
         LOGGER.debug('All tasks cancelled')
 
-        for task in tasks:
-            if task.cancelled():
-                continue
-            task_ex = task.exception()
-            # Ignore normal socket closures and uncaught cancels
-            if task_ex is not None \
-                    and not isinstance(task_ex, ConnectionClosedOK):
+        for task, result in zip(tasks, results):
+            # Ignore successes, normal socket closures, and uncaught cancels
+            if isinstance(result, BaseException) and not isinstance(
+                result, (ConnectionClosedOK, asyncio.CancelledError)
+            ):
                 LOGGER.error('Unexpected exception found during shutdown:')
-                self.loop.call_exception_handler({
+                loop.call_exception_handler({
                     'message': 'Unexpected exception found during shutdown',
-                    'exception': task_ex,
+                    'exception': result,
                     'task': task
                 })
 
         LOGGER.debug('Shutting down async generators...')
-        await self.loop.shutdown_asyncgens()
+        await loop.shutdown_asyncgens()
         LOGGER.debug('Async generators shut down')
+        LOGGER.info('Bot stopped')
+        self.flush_log_buffers()
 
 
     # Guild-record-related #
@@ -222,14 +298,26 @@ class SassBot(commands.Bot):
     async def inactivity_checker(self):
         """Periodic task that removes inactive voice connections."""
         try:
+            # Wake on a fixed schedule so time spent checking doesn't add up
+            next_wake = self.loop.time()
             while True:
-                for record in self.guild_db.records.values():
+                # Snapshot the records since guilds may join while we await
+                for record in tuple(self.guild_db.records.values()):
+                    # Idle guilds without a voice client have nothing to check
+                    if not record.is_active and not record.guild.voice_client:
+                        continue
                     # Tell the voice controller to check it
                     await self.voice_controller.check_record_for_inactivity(
                         record
                     )
 
-                await asyncio.sleep(self.active_timeout_check_interval_s)
+                next_wake += self.active_timeout_check_interval_s
+                now = self.loop.time()
+                # If a pass overran its interval, restart the schedule a full
+                #   interval from now rather than running passes back to back
+                if next_wake < now:
+                    next_wake = now + self.active_timeout_check_interval_s
+                await asyncio.sleep(next_wake - now)
 
         except asyncio.CancelledError:
             LOGGER.debug('Inactivity checking task was cancelled')
@@ -241,46 +329,64 @@ class SassBot(commands.Bot):
             LOGGER.critical('Inactivity checking task failed:', exc_info=True)
             await self.handle_crit('Inactivity checking task failed')
 
+    def flush_log_buffers(self):
+        """Write out any buffered log messages."""
+        for handler in self.log_buffers:
+            handler.flush()
+
+    async def log_flusher(self):
+        """Periodic task that flushes buffered log messages.
+
+        Buffered handlers flush themselves when full or on severe messages;
+        this keeps routine messages from sitting in the buffer indefinitely.
+        """
+        try:
+            while True:
+                await asyncio.sleep(self.log_flush_interval_s)
+                self.flush_log_buffers()
+        except asyncio.CancelledError:
+            LOGGER.debug('Log flushing task was cancelled')
+
+    def banana_name(self):
+        """Pick a name to call someone who messed up."""
+        if random() < self.RARE_BANANA_NAME_CHANCE:
+            return choice(self.RARE_BANANA_NAMES)
+        return choice(self.BANANA_NAMES)
+
     # Event overriders #
     async def check_err_count(self, ctx):
         """See if the author of the message is being a severe banana."""
         author = ctx.author
-        if author in self.err_count:
-            self.err_count[author] += 1
-            newval = self.err_count[author]
-            if newval == 3:
-                await ctx.send(
-                    "That's the third command in a row you messed up."
-                )
-            elif newval == 6:
-                await ctx.send("You really aren't good at this.")
-            elif newval >= 9 and not newval % 3:
-                await ctx.send(
-                    f'Are you doing this on purpose, {author.mention}? '
-                    'What are you trying to gain, huh?'
-                )
-        else:
-            self.err_count[author] = 1
+        self.err_count[author.id] += 1
+        newval = self.err_count[author.id]
+        if newval == 3:
+            await ctx.send("That's the third command in a row you messed up.")
+        elif newval == 6:
+            await ctx.send("You really aren't good at this.")
+        elif newval >= 9 and not newval % 3:
+            await ctx.send(
+                f'Are you doing this on purpose, {author.mention}? '
+                'What are you trying to gain, huh?'
+            )
 
     async def on_command_error(self, ctx, ex):
         """Perform error handling, reporting (to the guilds), and logging."""
         await self.check_err_count(ctx)
         ex_type = type(ex)
 
-        if ex_type == commands.errors.CommandNotFound:
-            await ctx.send('Invalid command.')
-
-        elif ex_type == commands.errors.MissingRequiredArgument:
-            await ctx.send(
-                'You did not specify the correct number of arguments. '
-                f'Try running `{self.command_prefix}help {ctx.command.name}`, '
-                f'you {choice(self.BANANA_NAMES)}.'
-            )
+        response = self.ERROR_RESPONSES.get(ex_type)
+        if response:
+            await ctx.send(response.format(
+                ex=ex,
+                prefix=self.command_prefix,
+                command=ctx.command,
+                banana=self.banana_name()
+            ))
 
         elif ex_type == commands.errors.CommandInvokeError \
             and type(ex.original) == BananaCrime:
             await ctx.send(
-                f'{ex.original.crime}, you {choice(self.BANANA_NAMES)}.'
+                f'{ex.original.crime}, you {self.banana_name()}.'
             )
 
         elif ex_type == commands.errors.CommandInvokeError \
@@ -294,42 +400,6 @@ class SassBot(commands.Bot):
             )
             raise ex
 
-        elif ex_type == commands.errors.NotOwner:
-            await ctx.send("You aren't my owner, you banana.")
-
-        elif ex_type == commands.errors.BadArgument:
-            await ctx.send(
-                f'{ex.args[0]} '
-                f'Try running `{self.command_prefix}help {ctx.command.name}`, '
-                f'you {choice(self.BANANA_NAMES)}.'
-            )
-
-        elif ex_type == commands.errors.UnexpectedQuoteError:
-            await ctx.send(
-                "If you include a quote in an argument, you'll either need to "
-                "fully encase what you're trying to send me in quotes, or you "
-                f"need to escape it, you {choice(self.BANANA_NAMES)}."
-            )
-
-        elif ex_type == commands.errors.InvalidEndOfQuotedStringError:
-            await ctx.send(
-                "You cannot place a character directly after the end of a "
-                f"quoted string, you {choice(self.BANANA_NAMES)}."
-            )
-
-        elif ex_type == commands.errors.ExpectedClosingQuoteError:
-            await ctx.send(
-                "You did not complete your quoted string, "
-                f"you {choice(self.BANANA_NAMES)}."
-            )
-
-        elif ex_type == commands.errors.ChannelNotFound:
-            await ctx.send(
-                "That channel doesn't exist; make sure to match casing "
-                "and encase the channel name in quotes if it has spaces in it, "
-                f"you {choice(self.BANANA_NAMES)}."
-            )
-
         else:
             await ctx.send('what are you doing')
             LOGGER.error(
@@ -340,13 +410,11 @@ class SassBot(commands.Bot):
     async def on_command_completion(self, ctx):
         """Update my list of error counts and praise people if need be."""
         author = ctx.author
-        if author in self.err_count:
-            if self.err_count[author] >= 9:
-                await ctx.send(
-                    f'Attention Server: {author.mention} FINALLY knows how to '
-                    'act like a normal human being!'
-                )
-            del self.err_count[author]
+        if self.err_count.pop(author.id, 0) >= 9:
+            await ctx.send(
+                f'Attention Server: {author.mention} FINALLY knows how to '
+                'act like a normal human being!'
+            )
 
     async def on_command(self, ctx):
         """Log each command and refresh our last channel record."""
@@ -359,6 +427,9 @@ class SassBot(commands.Bot):
     async def on_ready(self):
         """Report I'm ready to go."""
         LOGGER.info(f'Logged in as {self.user}')
+        # This also fires on reconnects, so keep any records we already have
+        for guild in self.guilds:
+            self.guild_db.get_record(guild)
         await self.change_presence(activity=Game(f'{self.command_prefix}help'))
 
     async def on_guild_join(self, guild):
@@ -1,12 +1,13 @@
 import asyncio
 import os
+import tempfile
 import discord
 from discord import VoiceChannel
 from discord.ext import commands
 import random
 from gtts import gTTS
 # _extra_langs is needed for now since there's a bug in gTTS
-from gtts.lang import tts_langs, _extra_langs
+from gtts.lang import tts_langs, _extra_langs, _fallback_deprecated_lang
 from datetime import datetime
 from yt_dlp import YoutubeDL
 from yt_dlp.utils import DownloadError, UnsupportedError
@@ -14,6 +15,7 @@ from functools import partial
 import logging
 import editdistance
 from copy import deepcopy
+from types import MappingProxyType
 
 from exceptions import BananaCrime
 
@@ -27,8 +29,6 @@ DEFAULT_SB_REQUEST_FILENAME = 'sb_requests.txt'
 SOUND_DIR = 'sounds'
 # Default language to use with GTTS
 GTTS_DEFAULT_LANG = 'en-uk'
-# Where to store the temporary voice file when using GTTS
-GTTS_TEMP_FILE = f'{SOUND_DIR}/temp_voice.mp3'
 # Minimum edit distance for a requested `sb` sound request
 MIN_EDIT_DIST = 4
 
@@ -51,9 +51,54 @@ YTDL = YoutubeDL(YTDL_OPTS)
 # (Sometimes, YoutubeDL is unable to extract video info temporarily)
 YTDL_RETRIES = 3
 
+# Grab valid TTS languages from `gtts.lang` to give language options
+try:
+    VALID_TTS_LANGS = MappingProxyType(tts_langs())
+except RuntimeError:
+    VALID_TTS_LANGS = MappingProxyType(_extra_langs())
+# Message listing the above; constant, so only build it once
+LANG_HELP_MSG = 'Available languages:\n' + '\n'.join(
+    f'{v}: `{k}`' for k, v in VALID_TTS_LANGS.items()
+)
+
 LOGGER = logging.getLogger(__name__)
 
 
+def remove_temp_file(path):
+    """Delete a temporary file, only logging if that fails."""
+    try:
+        os.remove(path)
+    except OSError as ex:
+        LOGGER.error(
+            f'Could not remove temporary file {path}: '
+            f'{type(ex).__name__}, {ex.args!r}'
+        )
+
+
+def play_local(vclient, path, volume=0.5, delete_after=False, **ffmpeg_opts):
+    """Play a local audio file, releasing FFmpeg as soon as playback ends.
+
+    If delete_after is set, the file is deleted once playback ends.
+    Any additional keyword arguments are passed to `discord.FFmpegPCMAudio`.
+    """
+    source = discord.PCMVolumeTransformer(
+        discord.FFmpegPCMAudio(path, **ffmpeg_opts), volume
+    )
+
+    def cleanup(err):
+        source.cleanup()
+        if delete_after:
+            remove_temp_file(path)
+        # Passing our own callback means discord.py won't report this for us
+        if err:
+            LOGGER.error(
+                f'FFmpeg failed while playing {path}: '
+                f'{type(err).__name__}, {err.args!r}'
+            )
+
+    vclient.play(source, after=cleanup)
+
+
 async def schedule_sb_queue(ctx, queue):
     while queue:
         vclient = ctx.voice_client
@@ -63,15 +108,14 @@ async def schedule_sb_queue(ctx, queue):
             # TODO var this
             await asyncio.sleep(0.1)
             continue
-        path = queue.pop(0)
-        vclient.play(
-            discord.PCMVolumeTransformer(discord.FFmpegPCMAudio(path), 0.5)
-        )
+        play_local(vclient, queue.pop(0))
 
 
-def ffmpeg_error_catcher(loop, channel, err):
+def ffmpeg_error_catcher(bot, channel_id, err):
     """Passed into `VoiceContoller.play` to handle and report FFmpeg errors.
 
+    Only holds onto the ID of the requesting channel, which is only resolved
+    if something actually went wrong.
     Inspired by:
         https://discordpy.readthedocs.io/en/latest/faq.html#id13
     """
@@ -80,8 +124,15 @@ def ffmpeg_error_catcher(loop, channel, err):
     LOGGER.error(
         f'FFmpeg failed while streaming: {type(err).__name__}, {err.args!r}'
     )
+    channel = bot.get_channel(channel_id)
+    if not channel:
+        LOGGER.error(
+            "Not only did FFmpeg fail to stream, "
+            f"I couldn't find the channel that made the request: {channel_id}"
+        )
+        return
     reporter_coro = channel.send('Had an issue while streaming; try again.')
-    fut = asyncio.run_coroutine_threadsafe(reporter_coro, loop)
+    fut = asyncio.run_coroutine_threadsafe(reporter_coro, bot.loop)
     try:
         fut.result()
     except Exception as ex:
@@ -92,6 +143,15 @@ def ffmpeg_error_catcher(loop, channel, err):
         )
 
 
+def save_tts(text, lang, path):
+    """Synthesize text in the given language with gTTS and save it to path.
+
+    This blocks, so it should be run in an executor.
+    NOTE: Does not validate the language; check it against VALID_TTS_LANGS.
+    """
+    gTTS(text, lang=lang, lang_check=False).save(path)
+
+
 async def split_send(ctx, msg):
     """Send a message in segments of <2k characters.
 
@@ -218,12 +278,6 @@ class VoiceController(commands.Cog, name='Voice'):
     def __init__(self, bot, **kwargs):
         self.bot = bot
         self.parse_kwargs(kwargs)
-
-        # Grab valid TTS languages from `gtts.lang` to give language options
-        try:
-            self.valid_tts_langs = tts_langs()
-        except RuntimeError:
-            self.valid_tts_langs = _extra_langs()
         self.load_sounds()
 
     def parse_kwargs(self, kwargs):
@@ -240,14 +294,18 @@ class VoiceController(commands.Cog, name='Voice'):
         """Build the dictionaries relating categories and lists of sounds."""
         self.category_to_sounds = {}  # used for easy listing
         self.sound_to_category = {}   # used to quickly check for membership
+        self.sound_to_path = {}       # used to quickly find a sound to play
+        with os.scandir(SOUND_DIR) as entries:
+            categories = [entry.name for entry in entries if entry.is_dir()]
         # For each subdirectory (category) of sounds
-        for category in next(os.walk(SOUND_DIR))[1]:
-            # Associate the category with its list of sounds
-            sounds = [
-                sound[:-4] for sound in os.listdir(
-                    os.path.join(SOUND_DIR, category)
-                )
-            ]
+        for category in categories:
+            # Associate the category with its list of sounds, ignoring any
+            #   stray non-mp3 files
+            with os.scandir(os.path.join(SOUND_DIR, category)) as entries:
+                sounds = [
+                    entry.name[:-4] for entry in entries
+                    if entry.is_file() and entry.name.endswith('.mp3')
+                ]
             # Check for duplicates
             for sound in sounds:
                 if sound in self.sound_to_category:
@@ -257,18 +315,39 @@ class VoiceController(commands.Cog, name='Voice'):
                         f'vs {category}/{sound}'
                     )
                 self.sound_to_category[sound] = category
+                self.sound_to_path[sound] = \
+                    f'{SOUND_DIR}/{category}/{sound}.mp3'
             self.category_to_sounds[category] = sorted(sounds)
+        # Used to pick random sounds without rebuilding this every time
+        self._category_items = tuple(self.category_to_sounds.items())
+        # Maps names given to `sb` to what kind of thing they refer to, so it
+        #   only needs one lookup; categories win over sounds of the same name
+        self._sb_kind = dict.fromkeys(self.sound_to_path, 'sound')
+        self._sb_kind.update(
+            dict.fromkeys(self.category_to_sounds, 'category')
+        )
         # Build list of newest sounds
-        self.newest_sounds = [
-            os.path.basename(sound)[:-4] for sound in sorted(
-                [
-                    os.path.join(SOUND_DIR, category, f'{sound}.mp3')
-                    for sound, category in self.sound_to_category.items()
-                ],
-                key=os.path.getmtime,
-                reverse=True
-            )[:self.sb_num_new]
-        ]
+        self.newest_sounds = sorted(
+            self.sound_to_path,
+            key=lambda s: os.path.getmtime(self.sound_to_path[s]),
+            reverse=True
+        )[:self.sb_num_new]
+
+        # Prebuild listing messages since they only change on reload
+        self.sb_categories_msg = (
+            f'Available categories: {", ".join(self.category_to_sounds)}, '
+            'new, all'
+        )
+        self.sb_all_msg = 'All available sounds:\n' + '\n'.join(
+            '\n'.join(sounds) for sounds in self.category_to_sounds.values()
+        )
+        self.sb_new_msg = (
+            'Most recently added sounds:\n' + '\n'.join(self.newest_sounds)
+        )
+        self.sb_category_msgs = {
+            category: f'Category {category}: {", ".join(sounds)}'
+            for category, sounds in self.category_to_sounds.items()
+        }
 
     async def close(self):
         """Disconnect all voice clients."""
@@ -383,7 +462,7 @@ class VoiceController(commands.Cog, name='Voice'):
             )
 
         vclient = ctx.voice_client
-        async with self.bot.guild_records[ctx.guild.id].lock:
+        async with self.bot.guild_db.get_record(ctx.guild).lock:
             if vclient and vclient.is_connected():
                 if vclient.channel == channel:
                     raise BananaCrime("I'm already in this channel")
@@ -394,7 +473,7 @@ class VoiceController(commands.Cog, name='Voice'):
     @commands.command(pass_context=True)
     async def summon(self, ctx):
         """Join the voice channel of the caller."""
-        async with self.bot.guild_records[ctx.guild.id].lock:
+        async with self.bot.guild_db.get_record(ctx.guild).lock:
             await self._summon(ctx)
 
     @commands.command(pass_context=True)
@@ -416,7 +495,7 @@ class VoiceController(commands.Cog, name='Voice'):
         if not vclient:
             raise BananaCrime("I'm not in a voice channel")
 
-        guild_lock = self.bot.guild_records[ctx.guild.id].lock
+        guild_lock = self.bot.guild_db.get_record(ctx.guild).lock
         # If I was called at the same time as I'm processing a command,
         #   when I eventually get my turn to execute, I need to wait a moment
         #   before leaving, otherwise the library will be confused
@@ -432,19 +511,16 @@ class VoiceController(commands.Cog, name='Voice'):
                 )
             ctx.voice_client.stop()
             await ctx.voice_client.disconnect()
-        self.bot.guild_records[ctx.guild.id].mark_inactive()
+        self.bot.guild_db.get_record(ctx.guild).mark_inactive()
 
-    async def play_sound(self, ctx, category, sound):
-        """Helper that plays a given sound belonging to a given category."""
-        guild_lock = self.bot.guild_records[ctx.guild.id].lock
+    async def play_sound(self, ctx, sound):
+        """Helper that plays a given sound from the soundboard."""
+        guild_lock = self.bot.guild_db.get_record(ctx.guild).lock
         if guild_lock.locked():
             raise BananaCrime("I'm already trying to process a VC command")
         async with guild_lock:
             vclient = await self.prepare_to_play(ctx, False)
-        path = f'{SOUND_DIR}/{category}/{sound}.mp3'
-        vclient.play(
-            discord.PCMVolumeTransformer(discord.FFmpegPCMAudio(path), 0.5)
-        )
+        play_local(vclient, self.sound_to_path[sound])
 
     @commands.command(pass_context=True)
     async def sb(self, ctx, *desires):
@@ -453,53 +529,35 @@ class VoiceController(commands.Cog, name='Voice'):
         Call this command with no argument to see available sounds.
         """
         if not desires:
-            await ctx.send(
-                'Available categories: '
-                f'{", ".join(self.category_to_sounds)}, new, all'
-            )
+            await ctx.send(self.sb_categories_msg)
             return
 
         tgt_paths = []
         to_send = []
         for desire in desires:
+            kind = self._sb_kind.get(desire)
             if desire == 'all':
                 # Use split send since this guy can easily grow above 2k chars
-                await split_send(
-                    ctx,
-                    'All available sounds:\n'
-                    + '\n'.join([
-                        '\n'.join(sounds)
-                        for sounds in self.category_to_sounds.values()
-                    ])
-                )
+                await split_send(ctx, self.sb_all_msg)
                 return
 
             elif desire == 'new':
-                await ctx.send(
-                    'Most recently added sounds:\n'
-                    + '\n'.join(self.newest_sounds)
-                )
+                await ctx.send(self.sb_new_msg)
                 return
 
             # If they searched a category
-            elif desire in self.category_to_sounds:
-                await ctx.send(
-                    f'Category {desire}: '
-                    f'{", ".join(self.category_to_sounds[desire])}'
-                )
+            elif kind == 'category':
+                await ctx.send(self.sb_category_msgs[desire])
                 return
 
             elif desire == 'random':
-                category, sounds = random.choice(
-                    list(self.category_to_sounds.items())
-                )
+                _, sounds = random.choice(self._category_items)
                 sound = random.choice(sounds)
                 to_send.append(f"You just heard `{sound}`.")
 
             # If the sound exists
-            elif desire in self.sound_to_category:
+            elif kind == 'sound':
                 sound = desire
-                category = self.sound_to_category[sound]
 
             # See if we can guess what they meant
             else:
@@ -524,13 +582,12 @@ class VoiceController(commands.Cog, name='Voice'):
                     else:
                         continue
                 # Otherwise, go for it
-                category = self.sound_to_category.get(sound)
                 to_send.append(
                     f"`{desire}` isn't a valid sound, "
                     f"so I'll play `{sound}` instead."
                 )
 
-            tgt_paths.append(f'{SOUND_DIR}/{category}/{sound}.mp3')
+            tgt_paths.append(self.sound_to_path[sound])
 
         if not tgt_paths:
             raise BananaCrime(
@@ -538,7 +595,7 @@ class VoiceController(commands.Cog, name='Voice'):
                 f'try `{self.bot.command_prefix}sb` with no arguments'
             )
 
-        record = self.bot.guild_records[ctx.guild.id]
+        record = self.bot.guild_db.get_record(ctx.guild)
 
         # TODO run this in other places too, like maybe explicitly on shutdown
         #   or, if you were a cool kid, on leave, stop, blah blah blah
@@ -553,12 +610,7 @@ class VoiceController(commands.Cog, name='Voice'):
             vclient = await self.prepare_to_play(ctx, False)
 
         if len(tgt_paths) == 1:
-            vclient.play(
-                discord.PCMVolumeTransformer(
-                    discord.FFmpegPCMAudio(tgt_paths[0]),
-                    0.5
-                )
-            )
+            play_local(vclient, tgt_paths[0])
         else:
             record.sb_task = asyncio.create_task(
                 schedule_sb_queue(ctx, tgt_paths)
@@ -576,33 +628,38 @@ class VoiceController(commands.Cog, name='Voice'):
     async def saylang(self, ctx, lang=None, *, desire=None):
         """Use gTTS to play a text-to-speech message using a given language."""
         if not lang:
-            await ctx.send(
-                'Available languages:\n'
-                + '\n'.join([
-                    f'{v}: `{k}`' for k, v in self.valid_tts_langs.items()
-                ])
-            )
+            await ctx.send(LANG_HELP_MSG)
             return
         if not desire:
             raise BananaCrime('Give me text to speak')
+        # Map deprecated tags like our default (en-uk) onto their replacements
+        lang = _fallback_deprecated_lang(lang)
+        if lang not in VALID_TTS_LANGS:
+            raise BananaCrime('Invalid language')
 
-        async with self.bot.guild_records[ctx.guild.id].lock:
-            vclient = await self.prepare_to_play(ctx)
+        # Each message gets its own file so concurrent requests can't
+        #   overwrite each other; it's deleted once it's done playing
+        tts_fd, tts_path = tempfile.mkstemp(suffix='.mp3', dir=SOUND_DIR)
+        os.close(tts_fd)
         try:
-            tts = gTTS(desire, lang=lang)
-        except ValueError:
-            raise BananaCrime('Invalid language')
-        tts.save(GTTS_TEMP_FILE)
+            # gTTS blocks on both HTTP and disk, so keep it off the loop
+            await self.bot.loop.run_in_executor(
+                None, save_tts, desire, lang, tts_path
+            )
 
-        vclient.play(
-            discord.PCMVolumeTransformer(
-                discord.FFmpegPCMAudio(
+            # Nothing can be awaited between preparing and playing, otherwise
+            #   another command could grab the voice client in between
+            async with self.bot.guild_db.get_record(ctx.guild).lock:
+                vclient = await self.prepare_to_play(ctx)
+                play_local(
+                    vclient, tts_path, 1, delete_after=True,
                     # Suppress bitrate estimation warning
-                    GTTS_TEMP_FILE, options='-loglevel error'
-                ),
-                1
-            )
-        )
+                    options='-loglevel error'
+                )
+        except BaseException:
+            # Playback never started, so nothing else will clean this up
+            remove_temp_file(tts_path)
+            raise
 
     @commands.command(pass_context=True)
     async def play(self, ctx, *, desire: str=None):
@@ -624,7 +681,7 @@ class VoiceController(commands.Cog, name='Voice'):
 
         if not desire:
             raise BananaCrime('Give me a search term')
-        gvr = self.bot.guild_records[ctx.guild.id]
+        gvr = self.bot.guild_db.get_record(ctx.guild)
         if gvr.searching_ytdl:
             raise BananaCrime("I'm already trying to find a video")
 
@@ -650,7 +707,7 @@ class VoiceController(commands.Cog, name='Voice'):
                     vclient.play(
                         ytdl_src,
                         after=partial(
-                            ffmpeg_error_catcher, self.bot.loop, ctx.channel
+                            ffmpeg_error_catcher, self.bot, ctx.channel.id
                         )
                     )
             finally: